@@ -1,15 +1,24 @@
 import os
 import time
+import functools
 import sqlite3
 import requests
+import threading
 import traceback
-from datetime import datetime
-from atproto import Client, models
+from concurrent.futures import ThreadPoolExecutor
+from atproto import Client, Session, models
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from PIL import Image
 from io import BytesIO
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
 # =============================
 # CONFIG
 # =============================
@@ -23,9 +32,16 @@ BLUESKY_HANDLE = os.getenv("BLUESKY_HANDLE")
 BLUESKY_PASSWORD = os.getenv("BLUESKY_PASSWORD")
 
 DB_PATH = "state.db"
+SESSION_PATH = "session.txt"  # Exported Bluesky session, reused across restarts
 
 MAX_IMAGE_SIZE = 950 * 1024  # 950KB (under Bluesky's 976.56KB limit)
 MAX_IMAGE_DIMENSION = 2000  # Max width/height to resize to
+JPEG_FALLBACK_QUALITIES = tuple(range(85, 0, -10))  # Tried when quality 95 is too big
+
+HTTP_TIMEOUT = (5, 15)  # (connect, read) seconds
+
+GENRE_CACHE_TTL = 24 * 60 * 60  # Artist genre tags rarely change
+COVER_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # Cached album art is dropped after 30 days
 
 # =============================
 # HTTP SESSION (PRODUCTION SAFE)
@@ -34,14 +50,24 @@ MAX_IMAGE_DIMENSION = 2000  # Max width/height to resize to
 def create_session():
     session = requests.Session()
 
+    # Short, jittered backoff so a transient error doesn't eat the check
+    # interval; 429s still wait for the server's Retry-After
     retries = Retry(
-        total=5,
-        backoff_factor=1.5,
+        total=3,
+        backoff_factor=0.3,
+        backoff_jitter=0.3,
         status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET", "POST"],
+        allowed_methods=["GET", "HEAD", "POST"],
+        respect_retry_after_header=True,
     )
 
-    adapter = HTTPAdapter(max_retries=retries)
+    # Keep-alive pool shared across ticks so ListenBrainz, CoverArtArchive
+    # and MusicBrainz only pay the TLS handshake once per host
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=retries,
+    )
 
     session.mount("http://", adapter)
     session.mount("https://", adapter)
@@ -51,6 +77,9 @@ def create_session():
 
 session = create_session()
 
+# Worker pool for running independent API calls concurrently
+executor = ThreadPoolExecutor(max_workers=3)
+
 # =============================
 # BLUESKY CLIENT
 # =============================
@@ -58,7 +87,51 @@ session = create_session()
 client = Client()
 
 
+def save_session(event, bsky_session):
+    # Called by atproto on login and on every token refresh. The session holds
+    # the refresh JWT, so keep it owner-only and swap it in atomically
+    tmp_path = f"{SESSION_PATH}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # In case a stale temp file had looser permissions
+    with os.fdopen(fd, "w") as f:
+        f.write(bsky_session.export())
+    os.replace(tmp_path, SESSION_PATH)
+
+
+client.on_session_change(save_session)
+
+
+def resume_session():
+    if not os.path.exists(SESSION_PATH):
+        return False
+
+    try:
+        with open(SESSION_PATH) as f:
+            session_string = f.read().strip()
+
+        # Only resume the account configured in .env; a session saved for a
+        # different handle is discarded so the password login takes over
+        saved = Session.decode(session_string)
+        configured = (BLUESKY_HANDLE or "").lstrip("@").lower()
+        if configured not in (saved.handle.lower(), saved.did.lower()):
+            print(f"⚠️ Saved Bluesky session is for {saved.handle}, logging in again.")
+            os.remove(SESSION_PATH)
+            return False
+
+        client.login(session_string=session_string)
+        print("✅ Bluesky session resumed.")
+        return True
+    except Exception as e:
+        print(f"⚠️ Bluesky session resume failed: {e}")
+        return False
+
+
 def safe_login():
+    # Reuse the saved session (atproto refreshes expired tokens itself) and
+    # only fall back to a full password login when that fails
+    if resume_session():
+        return
+
     try:
         client.login(BLUESKY_HANDLE, BLUESKY_PASSWORD)
         print("✅ Bluesky login successful.")
@@ -72,8 +145,44 @@ def safe_login():
 # DATABASE
 # =============================
 
+# Opened once in init_db() and reused for the lifetime of the bot
+conn = None
+
+# Hot-path statements are kept as constants so the connection's statement
+# cache reuses the compiled query instead of re-preparing it every tick
+CHECK_POST_SQL = """
+    SELECT 1 FROM posts
+    WHERE artist=? AND title=? AND post_date=?
+    LIMIT 1
+"""
+
+INSERT_POST_SQL = """
+    INSERT INTO posts (artist, title, post_date)
+    VALUES (?, ?, ?)
+"""
+
+GET_COVER_SQL = "SELECT data, etag FROM covers WHERE mbid=?"
+
+SAVE_COVER_SQL = """
+    INSERT OR REPLACE INTO covers (mbid, data, fetched_at, etag)
+    VALUES (?, ?, ?, ?)
+"""
+
+PRUNE_COVERS_SQL = "DELETE FROM covers WHERE fetched_at < ?"
+
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    global conn
+
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+        PRAGMA mmap_size=30000000000;
+    """)
+
     c = conn.cursor()
 
     c.execute("""
@@ -85,59 +194,62 @@ def init_db():
         )
     """)
 
-    conn.commit()
-    conn.close()
-
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_posts_lookup
+        ON posts (artist, title, post_date)
+    """)
 
-def already_posted_today(artist, title):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS covers (
+            mbid TEXT PRIMARY KEY,
+            data BLOB,
+            fetched_at INTEGER,
+            etag TEXT
+        ) WITHOUT ROWID
+    """)
 
-    today = datetime.utcnow().date().isoformat()
+    prune_covers()
 
-    c.execute("""
-        SELECT * FROM posts
-        WHERE artist=? AND title=? AND post_date=?
-    """, (artist, title, today))
 
-    result = c.fetchone()
-    conn.close()
+def already_posted_today(artist, title, today):
+    c = conn.cursor()
 
-    return result is not None
+    c.execute(CHECK_POST_SQL, (artist, title, today))
 
+    return c.fetchone() is not None
 
-def save_post(artist, title):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
 
-    today = datetime.utcnow().date().isoformat()
+def save_posts(items):
+    """
+    Insert (artist, title, post_date) rows in a single transaction
+    """
+    # The connection is in autocommit mode, so open the transaction
+    # explicitly to get one WAL commit for the whole batch
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(INSERT_POST_SQL, items)
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
 
-    c.execute("""
-        INSERT INTO posts (artist, title, post_date)
-        VALUES (?, ?, ?)
-    """, (artist, title, today))
 
-    conn.commit()
-    conn.close()
+def save_post(artist, title, today):
+    save_posts([(artist, title, today)])
 
 
 # =============================
 # LISTENBRAINZ
 # =============================
 
-def get_now_playing():
-    url = f"https://api.listenbrainz.org/1/user/{LB_USERNAME}/playing-now"
-
-    headers = {"Authorization": f"Token {LB_TOKEN}"}
+# Validators from the last playing-now response, sent back as a conditional
+# GET so an unchanged feed comes back as a bodyless 304
+last_etag = None
+last_modified = None
+last_now_playing = None
 
-    response = session.get(url, headers=headers, timeout=15)
-
-    if response.status_code != 200:
-        print("⚠️ ListenBrainz API error:", response.status_code)
-        return None
-
-    data = response.json()
 
+def parse_now_playing(data):
     if "payload" not in data or "listens" not in data["payload"]:
         return None
 
@@ -155,38 +267,117 @@ def get_now_playing():
     additional = track.get("additional_info", {})
     release_mbid = additional.get("release_mbid")
 
+    # Tags submitted with the listen, used as genres when present
+    tags = additional.get("tags") or []
+
     return {
         "artist": artist,
         "title": title,
         "release": release,
         "release_mbid": release_mbid,
+        "tags": tags[:3],
     }
 
 
+def get_now_playing():
+    global last_etag, last_modified, last_now_playing
+
+    url = f"https://api.listenbrainz.org/1/user/{LB_USERNAME}/playing-now"
+
+    headers = {"Authorization": f"Token {LB_TOKEN}"}
+
+    if last_etag:
+        headers["If-None-Match"] = last_etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    response = session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+
+    if response.status_code == 304:
+        # Nothing changed since last tick, reuse the previous result
+        return last_now_playing
+
+    if response.status_code != 200:
+        print("⚠️ ListenBrainz API error:", response.status_code)
+        return None
+
+    last_now_playing = parse_now_playing(json_loads(response.content))
+    last_etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+
+    return last_now_playing
+
+
 # =============================
 # ALBUM ART
 # =============================
 
+def cover_unchanged(url, etag):
+    # Revalidate a cached cover with a HEAD request instead of re-downloading it
+    try:
+        response = session.head(
+            url,
+            headers={"If-None-Match": etag},
+            timeout=HTTP_TIMEOUT,
+            allow_redirects=True,
+        )
+    except Exception as e:
+        print("Album art revalidation failed, using cached copy:", e)
+        return True
+
+    if response.status_code == 304:
+        return True
+
+    return response.status_code == 200 and response.headers.get("ETag") == etag
+
+
+def prune_covers():
+    # Originals can be several MB each, so don't keep every cover ever played
+    conn.execute(PRUNE_COVERS_SQL, (int(time.time()) - COVER_CACHE_MAX_AGE,))
+
+
 def get_album_art(mbid):
     if not mbid:
         return None
 
     url = f"https://coverartarchive.org/release/{mbid}/front"
 
+    # Stale cached art is still better than none if the re-download fails
+    data = None
+
+    cached = conn.execute(GET_COVER_SQL, (mbid,)).fetchone()
+    if cached:
+        data, etag = cached
+        if not etag or cover_unchanged(url, etag):
+            return data
+
     try:
-        response = session.get(url, timeout=15)
+        response = session.get(url, timeout=HTTP_TIMEOUT)
         if response.status_code == 200:
+            conn.execute(SAVE_COVER_SQL, (
+                mbid,
+                response.content,
+                int(time.time()),
+                response.headers.get("ETag"),
+            ))
+            prune_covers()
             return response.content
     except Exception as e:
         print("Album art fetch failed:", e)
 
-    return None
+    return data
 
 
 # =============================
 # IMAGE PROCESSING
 # =============================
 
+def encode_jpeg(img, quality, optimize=False):
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=optimize)
+    return output.getvalue()
+
+
 def resize_image(image_bytes):
     """
     Resize image to fit within Bluesky's size and dimension limits
@@ -194,6 +385,11 @@ def resize_image(image_bytes):
     try:
         # Open the image
         img = Image.open(BytesIO(image_bytes))
+        source_width, source_height = img.size  # Before draft() shrinks it
+        
+        # Let libjpeg decode large JPEGs at a reduced scale (1/2, 1/4, 1/8)
+        # that is still at least MAX_IMAGE_DIMENSION; no-op for other formats
+        img.draft('RGB', (MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
         
         # Convert to RGB if necessary (remove alpha channel)
         if img.mode in ('RGBA', 'LA', 'P'):
@@ -214,35 +410,44 @@ def resize_image(image_bytes):
             new_width = int(width * ratio)
             new_height = int(height * ratio)
             
-            # Resize image
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            print(f"📏 Resized image from {width}x{height} to {new_width}x{new_height}")
+            # Resize image (bilinear is enough, draft() already got us close)
+            img = img.resize((new_width, new_height), Image.Resampling.BILINEAR)
+            print(f"📏 Resized image from {source_width}x{source_height} to {new_width}x{new_height}")
         
-        # Save to bytes with quality adjustment if needed
-        quality = 95
-        output = BytesIO()
+        # Save as JPEG (more compression than PNG), most covers fit first try
+        data = encode_jpeg(img, 95, optimize=True)
         
-        # Try saving with decreasing quality until size is under limit
-        while True:
-            output.seek(0)
-            output.truncate()
+        if len(data) >= MAX_IMAGE_SIZE:
+            print(f"📦 Image size: {len(data)/1024:.2f}KB, searching for a lower quality...")
             
-            # Save as JPEG (more compression than PNG)
-            img.save(output, format='JPEG', quality=quality, optimize=True)
+            # Bisect for the highest quality whose unoptimized encode fits.
+            # Search encodes skip the extra Huffman optimization pass, which
+            # only shrinks the output, so the optimized encode fits too
+            lo, hi = 0, len(JPEG_FALLBACK_QUALITIES) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if len(encode_jpeg(img, JPEG_FALLBACK_QUALITIES[mid])) < MAX_IMAGE_SIZE:
+                    hi = mid
+                else:
+                    lo = mid + 1
             
-            size = output.tell()
+            # The next step up may still fit once optimized, try it first
+            data = None
+            if lo > 0:
+                data = encode_jpeg(img, JPEG_FALLBACK_QUALITIES[lo - 1], optimize=True)
+                if len(data) < MAX_IMAGE_SIZE:
+                    lo -= 1
+                else:
+                    data = None
             
-            if size < MAX_IMAGE_SIZE or quality <= 10:
-                break
-                
-            # Reduce quality and try again
-            quality -= 10
-            print(f"📦 Image size: {size/1024:.2f}KB, reducing quality to {quality}...")
+            quality = JPEG_FALLBACK_QUALITIES[lo]
+            print(f"📦 Reducing quality to {quality}...")
+            if data is None:
+                data = encode_jpeg(img, quality, optimize=True)
         
-        final_size = output.tell()
-        print(f"✅ Final image size: {final_size/1024:.2f}KB")
+        print(f"✅ Final image size: {len(data)/1024:.2f}KB")
         
-        return output.getvalue()
+        return data
         
     except Exception as e:
         print(f"⚠️ Image processing failed: {e}")
@@ -253,20 +458,35 @@ def resize_image(image_bytes):
 # GENRES
 # =============================
 
-def get_genres(artist):
-    try:
-        url = f"https://musicbrainz.org/ws/2/artist/?query=artist:{artist}&fmt=json"
-        response = session.get(url, timeout=15)
+# ttl_bucket is part of the cache key so entries expire every GENRE_CACHE_TTL;
+# errors raise instead of returning, so failed lookups are never cached
+@functools.lru_cache(maxsize=512)
+def fetch_genres(artist, ttl_bucket):
+    # Phrase-quote the artist so spaces, colons and quotes in the name don't
+    # break the Lucene query; requests URL-encodes the parameters
+    escaped = artist.replace("\\", "\\\\").replace('"', '\\"')
+    params = {
+        "query": f'artist:"{escaped}"',
+        "fmt": "json",
+        "limit": 1,  # Only the top match is used
+    }
+
+    url = "https://musicbrainz.org/ws/2/artist/"
+    response = session.get(url, params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
 
-        if response.status_code != 200:
-            return []
+    data = json_loads(response.content)
+    if not data.get("artists"):
+        return ()
 
-        data = response.json()
-        if not data.get("artists"):
-            return []
+    tags = data["artists"][0].get("tags", [])
+    return tuple(tag["name"] for tag in tags[:3])
 
-        tags = data["artists"][0].get("tags", [])
-        return [tag["name"] for tag in tags[:3]]
+
+def get_genres(artist):
+    try:
+        ttl_bucket = int(time.monotonic() // GENRE_CACHE_TTL)
+        return list(fetch_genres(artist, ttl_bucket))
 
     except Exception as e:
         print("Genre lookup failed:", e)
@@ -277,11 +497,8 @@ def get_genres(artist):
 # PROGRESS BAR
 # =============================
 
-def generate_progress_bar():
-    # Fake animated-style static bar (visual only)
-    filled = 7
-    empty = 3
-    return "▰" * filled + "▱" * empty
+# Fake animated-style static bar (visual only), built once at import
+PROGRESS_BAR = "▰" * 7 + "▱" * 3
 
 
 # =============================
@@ -293,38 +510,35 @@ def create_hashtag_facets(text, hashtags):
     Create Bluesky facets for hashtags.
     Returns a tuple of (text_with_hashtags, facets)
     """
-    facets = []
-    
     # Add the hashtags to the text
     hashtag_text = " ".join(hashtags)
     full_text = f"{text}\n\n{hashtag_text}"
     
-    # Calculate the starting position of hashtags in the full text
-    hashtag_start = len(text) + 2  # +2 for the two newlines
+    # Facet indices are UTF-8 byte offsets, not character offsets, so the
+    # emoji in the post body (4 bytes each) must be counted as bytes
+    full_text_bytes = full_text.encode("utf-8")
     
-    current_pos = hashtag_start
+    # Hashtags start after the body and the two newlines
+    search_start = len(text.encode("utf-8")) + 2
     
+    spans = []
     for hashtag in hashtags:
-        # Find where this hashtag appears in the text
-        hashtag_without_hash = hashtag[1:]  # Remove the # for the tag value
-        
-        # Create the facet for this hashtag
-        facet = models.AppBskyRichtextFacet.Main(
-            features=[
-                models.AppBskyRichtextFacet.Tag(
-                    tag=hashtag_without_hash
-                )
-            ],
+        hashtag_bytes = hashtag.encode("utf-8")
+        byte_start = full_text_bytes.find(hashtag_bytes, search_start)
+        byte_end = byte_start + len(hashtag_bytes)
+        spans.append((hashtag[1:], byte_start, byte_end))  # Tag value drops the #
+        search_start = byte_end
+    
+    facets = [
+        models.AppBskyRichtextFacet.Main(
+            features=[models.AppBskyRichtextFacet.Tag(tag=tag)],
             index=models.AppBskyRichtextFacet.ByteSlice(
-                byte_start=current_pos,
-                byte_end=current_pos + len(hashtag)
+                byte_start=byte_start,
+                byte_end=byte_end
             )
         )
-        
-        facets.append(facet)
-        
-        # Move position past this hashtag plus the space
-        current_pos += len(hashtag) + 1  # +1 for the space
+        for tag, byte_start, byte_end in spans
+    ]
     
     return full_text, facets
 
@@ -344,29 +558,20 @@ def post_to_bluesky(text, image_bytes=None, hashtags=None):
             facets = None
 
         if image_bytes:
-            # Resize the image before uploading
-            resized_image = resize_image(image_bytes)
-            
-            if not resized_image:
-                print("⚠️ Image processing failed, posting without image")
-                client.send_post(
-                    text=full_text,
-                    facets=facets
-                )
-            else:
-                upload = client.upload_blob(resized_image)
-
-                client.send_post(
-                    text=full_text,
-                    facets=facets,
-                    embed={
-                        "$type": "app.bsky.embed.images",
-                        "images": [{
-                            "image": upload.blob,
-                            "alt": text.split('\n')[0]  # Use first line as alt text
-                        }]
-                    }
-                )
+            # Image was already resized by prepare_album_art()
+            upload = client.upload_blob(image_bytes)
+
+            client.send_post(
+                text=full_text,
+                facets=facets,
+                embed={
+                    "$type": "app.bsky.embed.images",
+                    "images": [{
+                        "image": upload.blob,
+                        "alt": text.split('\n')[0]  # Use first line as alt text
+                    }]
+                }
+            )
         else:
             client.send_post(
                 text=full_text,
@@ -386,7 +591,55 @@ def post_to_bluesky(text, image_bytes=None, hashtags=None):
 # MAIN LOGIC
 # =============================
 
+def prepare_album_art(mbid, skip):
+    """
+    Download and resize album art, returns (found, resized_image).
+    Stops early once `skip` is set because the track won't be posted.
+    """
+    if skip.is_set():
+        return False, None
+
+    image_bytes = get_album_art(mbid)
+    if not image_bytes or skip.is_set():
+        return bool(image_bytes), None
+
+    # Resize before uploading; Pillow releases the GIL while coding JPEGs
+    return True, resize_image(image_bytes)
+
+
+def wait_for(future, timeout, default):
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        print(f"⚠️ Background task timed out after {timeout}s")
+        return default
+
+
+# (next UTC midnight as epoch seconds, "YYYY-MM-DD") for the current day
+day_cache = (0, None)
+
+
+def utc_today():
+    global day_cache
+
+    # Reformat the date only once per day, otherwise it's a single compare
+    now = time.time()
+    if now >= day_cache[0]:
+        next_midnight = (int(now) // 86400 + 1) * 86400
+        day_cache = (next_midnight, time.strftime("%Y-%m-%d", time.gmtime(now)))
+
+    return day_cache[1]
+
+
+# Last (artist, title, day) that was posted or found already posted, so a
+# track that keeps playing across ticks is skipped without touching SQLite
+# or other APIs; the day keeps the daily dedupe intact across midnight
+last_seen = None
+
+
 def check_now_playing():
+    global last_seen
+
     track = get_now_playing()
 
     if not track:
@@ -397,11 +650,28 @@ def check_now_playing():
     title = track["title"]
     release_mbid = track["release_mbid"]
 
-    if already_posted_today(artist, title):
+    today = utc_today()
+
+    if (artist, title, today) == last_seen:
+        print("Already posted, still playing.")
+        return
+
+    # Start the album art download + resize (and the MusicBrainz genre
+    # lookup when ListenBrainz had no tags) in the background so they
+    # overlap with the dedupe check below
+    genres_future = None if track["tags"] else executor.submit(get_genres, artist)
+    skip_art = threading.Event()
+    art_future = executor.submit(prepare_album_art, release_mbid, skip_art)
+
+    if already_posted_today(artist, title, today):
         print("Already posted today.")
+        # A running download can't be interrupted, but the resize is skipped;
+        # a finished genre lookup just stays in the cache
+        skip_art.set()
+        last_seen = (artist, title, today)
         return
 
-    genres = get_genres(artist)
+    genres = wait_for(genres_future, 30, []) if genres_future else track["tags"]
     
     # Create hashtags list
     hashtags = ["#NowPlaying"]
@@ -415,20 +685,21 @@ def check_now_playing():
         genre_tag = f"#{genre.replace(' ', '')}"
         hashtags.append(genre_tag)
 
-    progress_bar = generate_progress_bar()
-
     post_text = f"""🎧 KeeCloud Music
 
 🎵 {artist} – {title}
 
-{progress_bar}"""
+{PROGRESS_BAR}"""
 
-    image = get_album_art(release_mbid)
+    found_art, image = wait_for(art_future, 60, (False, None))
+    if found_art and not image:
+        print("⚠️ Image processing failed, posting without image")
 
     success = post_to_bluesky(post_text, image, hashtags)
 
     if success:
-        save_post(artist, title)
+        save_post(artist, title, today)
+        last_seen = (artist, title, today)
 
 
 # =============================